@@ -1,23 +1,33 @@
 import os
+import atexit
+import copy
+import gzip
 import logging
+import queue
+import re
+import threading
 import time
+from logging.handlers import QueueHandler, QueueListener
 from datetime import datetime
 from time import perf_counter
-from flask import Flask, jsonify, request, Response, g
+from flask import Flask, request, Response, g
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import event
+from sqlalchemy import bindparam, delete, event, insert, select, text, update
+import orjson
+from gevent import monkey
 from pythonjsonlogger import jsonlogger
-from prometheus_client import generate_latest, CONTENT_TYPE_LATEST, Counter, Histogram
+from prometheus_client import generate_latest, CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Histogram, PlatformCollector, multiprocess
 
-from opentelemetry import trace, metrics
+from opentelemetry import trace
 from opentelemetry.sdk.trace import TracerProvider
 from opentelemetry.sdk.trace.export import BatchSpanProcessor
-from opentelemetry.sdk.metrics import MeterProvider
+from opentelemetry.sdk.trace.sampling import ParentBased, TraceIdRatioBased
 from opentelemetry.sdk._logs import LoggerProvider, LoggingHandler
 from opentelemetry.sdk._logs.export import BatchLogRecordProcessor
-from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
-from opentelemetry.exporter.otlp.proto.http._log_exporter import OTLPLogExporter
+from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExporter
+from opentelemetry.exporter.otlp.proto.grpc._log_exporter import OTLPLogExporter
 from opentelemetry.sdk.resources import Resource
 from opentelemetry.instrumentation.flask import FlaskInstrumentor
 from opentelemetry.instrumentation.sqlalchemy import SQLAlchemyInstrumentor
@@ -25,68 +35,132 @@ from opentelemetry.instrumentation.logging import LoggingInstrumentor
 from opentelemetry.trace import Status, StatusCode
 from opentelemetry._logs import set_logger_provider
 
+if monkey.is_module_patched("socket"):
+    # Running under gunicorn's gevent worker, which monkey-patches the stdlib
+    # before importing the app; grpcio needs its own hook to yield to the hub
+    # instead of blocking every greenlet during an OTLP export
+    from grpc.experimental import gevent as grpc_gevent
+    grpc_gevent.init_gevent()
+
+class NonBlockingQueueHandler(QueueHandler):
+    """QueueHandler that never blocks the caller and keeps exceptions structured.
+
+    Records are dropped when the queue is full. The traceback is rendered into
+    exc_text so the JSON formatter on the listener thread still emits it as its
+    own field instead of appended to the message.
+    """
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.msg = record.message
+        record.args = None
+        record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            pass
+
 logHandler = logging.StreamHandler()
+# Trace context arrives as otelTraceID/otelSpanID, added by LoggingInstrumentor
 formatter = jsonlogger.JsonFormatter(
-    '%(asctime)s %(name)s %(levelname)s %(message)s %(trace_id)s %(span_id)s'
+    '%(asctime)s %(name)s %(levelname)s %(message)s'
 )
 logHandler.setFormatter(formatter)
+
+# Request threads only enqueue; JSON formatting and the stderr write happen on
+# the listener thread
+log_queue = queue.Queue(maxsize=10000)
+log_listener = QueueListener(log_queue, logHandler, respect_handler_level=True)
+log_listener.start()
+atexit.register(log_listener.stop)
+
 logger = logging.getLogger()
-logger.addHandler(logHandler)
+logger.addHandler(NonBlockingQueueHandler(log_queue))
 logger.setLevel(logging.INFO)
 
+# Nothing formats thread fields, so skip collecting them on every LogRecord.
+# Process fields stay on: the flag is process-global and gunicorn's own error
+# log format uses %(process)d in each worker.
+logging.logThreads = False
+
 resource = Resource.create({
     "service.name": os.getenv("OTEL_SERVICE_NAME", "flask-backend"),
     "service.version": "1.0.0",
     "deployment.environment": "lab"
 })
 
-tracer_provider = TracerProvider(resource=resource)
+# Browser-originated requests follow the parent's sampling decision; the
+# ratio only applies to traces that start at the backend
+tracer_provider = TracerProvider(
+    resource=resource,
+    sampler=ParentBased(TraceIdRatioBased(float(os.getenv("OTEL_TRACES_SAMPLER_ARG", "1.0"))))
+)
 otlp_trace_exporter = OTLPSpanExporter(
-    endpoint=f"{os.getenv('OTEL_EXPORTER_OTLP_ENDPOINT', 'http://otel-collector:4318')}/v1/traces"
+    endpoint=os.getenv('OTEL_EXPORTER_OTLP_ENDPOINT', 'http://otel-collector:4317'),
+    insecure=True
+)
+# Larger, less frequent batches mean fewer OTLP export calls and less
+# serialization overhead per span. The queue bounds memory (a few KB per
+# queued span); anything beyond it is dropped rather than blocking requests.
+span_processor = BatchSpanProcessor(
+    otlp_trace_exporter,
+    max_queue_size=int(os.getenv("OTEL_BSP_MAX_QUEUE_SIZE", "4096")),
+    schedule_delay_millis=int(os.getenv("OTEL_BSP_SCHEDULE_DELAY", "2000")),
+    max_export_batch_size=int(os.getenv("OTEL_BSP_MAX_EXPORT_BATCH_SIZE", "1024")),
+    export_timeout_millis=int(os.getenv("OTEL_BSP_EXPORT_TIMEOUT", "10000"))
 )
-span_processor = BatchSpanProcessor(otlp_trace_exporter)
 tracer_provider.add_span_processor(span_processor)
 trace.set_tracer_provider(tracer_provider)
-tracer = trace.get_tracer(__name__)
-
-meter_provider = MeterProvider(resource=resource)
-metrics.set_meter_provider(meter_provider)
-meter = metrics.get_meter(__name__)
 
 logger_provider = LoggerProvider(resource=resource)
 set_logger_provider(logger_provider)
 
 otlp_log_exporter = OTLPLogExporter(
-    endpoint=f"{os.getenv('OTEL_EXPORTER_OTLP_ENDPOINT', 'http://otel-collector:4318')}/v1/logs",
+    endpoint=os.getenv('OTEL_EXPORTER_OTLP_ENDPOINT', 'http://otel-collector:4317'),
+    insecure=True,
     timeout=5
 )
-logger_provider.add_log_record_processor(BatchLogRecordProcessor(otlp_log_exporter))
-
+# Same batching tradeoff as spans: logs reach Loki up to ~2s later in exchange
+# for fewer export calls
+logger_provider.add_log_record_processor(BatchLogRecordProcessor(
+    otlp_log_exporter,
+    max_queue_size=int(os.getenv("OTEL_BLRP_MAX_QUEUE_SIZE", "4096")),
+    schedule_delay_millis=int(os.getenv("OTEL_BLRP_SCHEDULE_DELAY", "2000")),
+    max_export_batch_size=int(os.getenv("OTEL_BLRP_MAX_EXPORT_BATCH_SIZE", "1024")),
+    export_timeout_millis=int(os.getenv("OTEL_BLRP_EXPORT_TIMEOUT", "10000"))
+))
+
+# Stays on the request thread: it reads the active span for trace correlation
+# at emit time, and BatchLogRecordProcessor already exports in the background
 otel_log_handler = LoggingHandler(level=logging.INFO, logger_provider=logger_provider)
 logging.getLogger().addHandler(otel_log_handler)
 
-database_query_duration = meter.create_histogram(
-    name="database_query_duration_seconds",
-    description="Database query duration in seconds",
-    unit="s"
-)
-
 prom_http_requests_total = Counter(
     'http_requests_total',
     'Total HTTP requests',
-    ['method', 'endpoint', 'status_code']
+    ['method', 'endpoint', 'status_class']
 )
 
+# No status label and six buckets: every label combination costs one series
+# per bucket, and status is already broken out by http_requests_total. The 0.5
+# and 1 boundaries match the P95 SLI gauge thresholds on the SLO dashboard.
 prom_http_request_duration_seconds = Histogram(
     'http_request_duration_seconds',
     'HTTP request duration in seconds',
-    ['method', 'endpoint', 'status_code']
+    ['method', 'endpoint'],
+    buckets=(0.005, 0.025, 0.1, 0.5, 1, 2.5)
 )
 
 prom_http_errors_total = Counter(
     'http_errors_total',
     'Total HTTP errors',
-    ['method', 'endpoint', 'status_code']
+    ['method', 'endpoint', 'status_class']
 )
 
 prom_db_query_duration_seconds = Histogram(
@@ -96,14 +170,72 @@ prom_db_query_duration_seconds = Histogram(
     buckets=(0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.25, 0.5, 1, 2)
 )
 
+# Rendered /metrics body, re-generated at most once per METRICS_CACHE_TTL seconds
+# so back-to-back scrapes (Prometheus + the compose healthcheck) reuse one render.
+# The gzip variant is compressed alongside it since Prometheus always asks for it.
+METRICS_CACHE_TTL = 1.0
+_metrics_cache = {"t": float("-inf"), "body": b"", "gzip": b""}
+_metrics_lock = threading.Lock()
+
+# Route endpoints allowed as a label value; anything else is reported as "other"
+# so scanners and unmatched URLs cannot grow the series count
+ALLOWED_ENDPOINTS = frozenset({
+    "get_tasks",
+    "get_task",
+    "create_task",
+    "update_task",
+    "delete_task",
+    "simulate_error",
+    "simulate_slow",
+    "db_smoke"
+})
+
+# Same for the method label: clients can send any method token
+ALLOWED_METHODS = frozenset({"GET", "POST", "PUT", "DELETE", "OPTIONS", "HEAD"})
+
+# (method, endpoint, status_class) -> bound (requests, duration, errors) children,
+# so the hot path skips the locked labels() lookup after the first request.
+# Every key component comes from a fixed set, so the cache needs no eviction.
+# The errors child is only bound for 4xx/5xx keys to avoid empty error series.
+_label_cache = {}
+
+class OrjsonProvider(DefaultJSONProvider):
+    """Flask JSON provider backed by orjson, used by request.get_json() and jsonify()."""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=orjson.OPT_NAIVE_UTC | orjson.OPT_NON_STR_KEYS).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 CORS(app)
 
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:////app/data/tasks.db'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-db = SQLAlchemy(app)
-
-FlaskInstrumentor().instrument_app(app)
+# Pinned rather than left to the dialect defaults: connections are reused from
+# a pool instead of opened per request, and SQLite connections may be handed
+# between the threads/greenlets that serve requests
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    "pool_size": 5,
+    "max_overflow": 10,
+    "pool_pre_ping": False,
+    "connect_args": {"check_same_thread": False}
+}
+# Rows read after a commit are served from the session as loaded, not re-SELECTed
+db = SQLAlchemy(app, session_options={"expire_on_commit": False})
+
+# Scrapes and healthchecks are high-volume and carry no signal worth a span,
+# a log line or a Prometheus series
+UNINSTRUMENTED_PATHS = ("/health", "/metrics")
+
+# FlaskInstrumentor re.search()es these against the full request URL, so anchor
+# them to the exact path (query string allowed) to match before_request's check
+FlaskInstrumentor().instrument_app(
+    app,
+    excluded_urls=",".join(rf"^https?://[^/]+{re.escape(p)}(\?.*)?$" for p in UNINSTRUMENTED_PATHS)
+)
 LoggingInstrumentor().instrument(set_logging_format=True)
 
 class Task(db.Model):
@@ -112,7 +244,9 @@ class Task(db.Model):
     title = db.Column(db.String(200), nullable=False)
     description = db.Column(db.Text, nullable=True)
     completed = db.Column(db.Boolean, default=False)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # Stored as the ISO string the API returns, so reads need no datetime
+    # parse/format round trip (SQLite has no native datetime type anyway)
+    created_at = db.Column(db.String(32), default=lambda: datetime.utcnow().isoformat())
 
     def to_dict(self):
         return {
@@ -120,9 +254,50 @@ class Task(db.Model):
             'title': self.title,
             'description': self.description,
             'completed': self.completed,
-            'created_at': self.created_at.isoformat()
+            'created_at': self.created_at
         }
 
+tasks_table = Task.__table__
+TASK_COLUMNS = (
+    tasks_table.c.id,
+    tasks_table.c.title,
+    tasks_table.c.description,
+    tasks_table.c.completed,
+    tasks_table.c.created_at
+)
+
+# Core statements built once at import: the compiled-statement cache is hit on
+# every request and no ORM Query or entity is constructed. UPDATE takes its SET
+# columns from whichever keys the execute() parameters carry.
+INSERT_TASK = insert(tasks_table).returning(*TASK_COLUMNS)
+SELECT_ALL_COLS = select(*TASK_COLUMNS)
+SELECT_BY_ID = select(*TASK_COLUMNS).where(tasks_table.c.id == bindparam("task_id"))
+UPDATE_BY_ID = (
+    update(tasks_table)
+    .where(tasks_table.c.id == bindparam("task_id"))
+    .returning(*TASK_COLUMNS)
+)
+DELETE_BY_ID = delete(tasks_table).where(tasks_table.c.id == bindparam("task_id"))
+
+def _set_sqlite_pragmas(dbapi_conn, connection_record):
+    # WAL + synchronous=NORMAL drops the fsync from every commit (only checkpoints
+    # sync); a 256 MiB mmap window, a 64 MiB page cache and in-memory temp
+    # tables keep reads off the read() syscall path
+    cursor = dbapi_conn.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA mmap_size=268435456")
+    cursor.execute("PRAGMA cache_size=-65536")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.close()
+
+_OP_MAP = {"INSERT": "INSERT", "UPDATE": "UPDATE", "DELETE": "DELETE", "SELECT": "SELECT"}
+# Only four operation values exist, so their histogram children are bound once
+_DB_OP_CHILDREN = {
+    prefix: prom_db_query_duration_seconds.labels(operation=op) for prefix, op in _OP_MAP.items()
+}
+_DB_SELECT_CHILD = _DB_OP_CHILDREN["SELECT"]
+
 def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
     context._query_start_time = perf_counter()
 
@@ -134,303 +309,367 @@ def _after_cursor_execute(conn, cursor, statement, parameters, context, executem
 
     elapsed = perf_counter() - started
 
-    s = statement.lstrip().upper()
-    op = "SELECT"
-    if s.startswith("INSERT"):
-        op = "INSERT"
-    elif s.startswith("UPDATE"):
-        op = "UPDATE"
-    elif s.startswith("DELETE"):
-        op = "DELETE"
-
-    prom_db_query_duration_seconds.labels(operation=op).observe(elapsed)
+    # lstrip() returns the same object when there is no leading whitespace,
+    # so only the 6-char prefix is copied
+    child = _DB_OP_CHILDREN.get(statement.lstrip()[:6].upper(), _DB_SELECT_CHILD)
+    child.observe(elapsed)
 
 with app.app_context():
     os.makedirs('/app/data', exist_ok=True)
+    # Must be registered before the first connection is opened by create_all()
+    event.listen(db.engine, "connect", _set_sqlite_pragmas)
     SQLAlchemyInstrumentor().instrument(engine=db.engine)
     db.create_all()
+    # One-time migration for rows written while created_at was a DateTime
+    # column ("YYYY-MM-DD HH:MM:SS.ffffff"); a no-op once they are ISO strings
+    db.session.execute(text(
+        "UPDATE tasks SET created_at = replace(created_at, ' ', 'T') WHERE created_at LIKE '% %'"
+    ))
+    db.session.commit()
     logger.info("Database initialized")
 
     event.listen(db.engine, "before_cursor_execute", _before_cursor_execute)
     event.listen(db.engine, "after_cursor_execute", _after_cursor_execute)
     logger.info("SQLAlchemy event listeners registered for DB query duration tracking")
 
+# Span attributes whose values never change, built once at import
+SIMULATED_ERROR_SPAN_ATTRS = {"error.simulated": True}
+
+def jresp(obj, status=200):
+    """JSON response serialized with orjson instead of jsonify's stdlib encoder."""
+    return Response(
+        orjson.dumps(obj, option=orjson.OPT_NAIVE_UTC),
+        status=status,
+        mimetype="application/json"
+    )
+
+# /health body rebuilt at most once per second; probes within the same second
+# get the same pre-serialized bytes
+_health_cache = {"t": None, "body": b""}
+
+def _health_body():
+    t = int(time.time())
+    if t != _health_cache["t"]:
+        # body before t: a reader that sees the new second also sees its body
+        _health_cache["body"] = orjson.dumps(
+            {"status": "healthy", "timestamp": datetime.utcfromtimestamp(t).isoformat()}
+        )
+        _health_cache["t"] = t
+    return _health_cache["body"]
+
 @app.before_request
 def before_request():
-    request.start_time = time.time()
-    g.prom_start_time = time.time()
-    current_span = trace.get_current_span()
-    logger.info(
-        "Incoming request",
-        extra={
-            "method": request.method,
-            "path": request.path,
-            "trace_id": format(current_span.get_span_context().trace_id, '032x') if current_span else None,
-            "span_id": format(current_span.get_span_context().span_id, '016x') if current_span else None
-        }
-    )
+    # after_request only records metrics/logs when the request timer is set
+    if request.path in UNINSTRUMENTED_PATHS:
+        return
+    g.t0 = perf_counter()
+    # Per-request start/finish logs repeat what the server span already records,
+    # so they are DEBUG-only and never reach the OTLP log pipeline at INFO
+    if logger.isEnabledFor(logging.DEBUG):
+        # IDs are only rendered when a log record will actually be emitted
+        ctx = trace.get_current_span().get_span_context()
+        if ctx.is_valid:
+            g.trace_hex = f"{ctx.trace_id:032x}"
+            g.span_hex = f"{ctx.span_id:016x}"
+        else:
+            g.trace_hex = g.span_hex = None
+        logger.debug(
+            "Incoming request",
+            extra={
+                "method": request.method,
+                "path": request.path,
+                "trace_id": g.trace_hex,
+                "span_id": g.span_hex
+            }
+        )
 
 @app.after_request
 def after_request(response):
-    if hasattr(request, 'start_time'):
-        duration = time.time() - request.start_time
-        method = request.method
-        endpoint = request.endpoint or "unknown"
-        status_code = str(response.status_code)
+    t0 = g.get("t0")
+    if t0 is not None:
+        duration = perf_counter() - t0
+        method = request.method if request.method in ALLOWED_METHODS else "other"
+        endpoint = request.endpoint if request.endpoint in ALLOWED_ENDPOINTS else "other"
+        status_class = f"{response.status_code // 100}xx"
 
         # Record Prometheus client metrics (exposed at /metrics)
         # This is the ONLY source of metrics for Prometheus now
-        if hasattr(g, 'prom_start_time'):
-            prom_duration = time.time() - g.prom_start_time
-            prom_http_requests_total.labels(
-                method=method,
-                endpoint=endpoint,
-                status_code=status_code
-            ).inc()
-
-            prom_http_request_duration_seconds.labels(
-                method=method,
-                endpoint=endpoint,
-                status_code=status_code
-            ).observe(prom_duration)
-
-            if response.status_code >= 400:
-                prom_http_errors_total.labels(
-                    method=method,
-                    endpoint=endpoint,
-                    status_code=status_code
-                ).inc()
-
-        current_span = trace.get_current_span()
-        logger.info(
-            "Request completed",
-            extra={
-                "method": method,
-                "path": request.path,
-                "status_code": response.status_code,
-                "duration_seconds": duration,
-                "trace_id": format(current_span.get_span_context().trace_id, '032x') if current_span else None,
-                "span_id": format(current_span.get_span_context().span_id, '016x') if current_span else None
-            }
-        )
+        key = (method, endpoint, status_class)
+        children = _label_cache.get(key)
+        if children is None:
+            children = _label_cache.setdefault(key, (
+                prom_http_requests_total.labels(*key),
+                prom_http_request_duration_seconds.labels(method, endpoint),
+                prom_http_errors_total.labels(*key) if response.status_code >= 400 else None
+            ))
+        requests_child, duration_child, errors_child = children
+
+        requests_child.inc()
+        duration_child.observe(duration)
+
+        if errors_child is not None:
+            errors_child.inc()
+
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                "Request completed",
+                extra={
+                    "method": request.method,
+                    "path": request.path,
+                    "status_code": response.status_code,
+                    "duration_seconds": duration,
+                    "trace_id": g.get("trace_hex"),
+                    "span_id": g.get("span_hex")
+                }
+            )
 
     return response
 
 @app.route('/health', methods=['GET'])
 def health_check():
-    with tracer.start_as_current_span("health_check") as span:
-        span.set_attribute("health.status", "healthy")
-        return jsonify({"status": "healthy", "timestamp": datetime.utcnow().isoformat()}), 200
+    # Excluded from FlaskInstrumentor and the request hooks: no span, timer,
+    # log record or metric labels are touched per probe
+    return Response(_health_body(), status=200, mimetype="application/json")
 
 @app.route('/api/tasks', methods=['GET'])
 def get_tasks():
-    with tracer.start_as_current_span("get_all_tasks") as span:
-        try:
-            query_start = time.time()
-            tasks = Task.query.all()
-            query_duration_time = time.time() - query_start
-
-            database_query_duration.record(query_duration_time, {
-                "operation": "select",
-                "table": "tasks"
+    span = trace.get_current_span()
+    rec = span.is_recording()
+    try:
+        query_start = perf_counter()
+        # Plain column rows skip ORM hydration of a Task per row
+        rows = db.session.execute(SELECT_ALL_COLS).all()
+        query_duration_time = perf_counter() - query_start
+
+        if rec:
+            span.set_attributes({
+                "db.query.duration": query_duration_time,
+                "db.result.count": len(rows)
             })
 
-            span.set_attribute("db.query.duration", query_duration_time)
-            span.set_attribute("db.result.count", len(tasks))
+        logger.info("Retrieved %d tasks from database", len(rows))
 
-            logger.info(f"Retrieved {len(tasks)} tasks from database")
-
-            return jsonify({
-                "tasks": [task.to_dict() for task in tasks],
-                "count": len(tasks)
-            }), 200
-        except Exception as e:
-            span.record_exception(e)
-            span.set_status(Status(StatusCode.ERROR, str(e)))
-            logger.error(f"Error retrieving tasks: {str(e)}", exc_info=True)
-            return jsonify({"error": "Failed to retrieve tasks"}), 500
+        tasks = [
+            {
+                "id": r[0],
+                "title": r[1],
+                "description": r[2],
+                "completed": r[3],
+                "created_at": r[4]
+            }
+            for r in rows
+        ]
+        return jresp({"tasks": tasks, "count": len(rows)}, 200)
+    except Exception as e:
+        span.record_exception(e)
+        span.set_status(Status(StatusCode.ERROR, str(e)))
+        logger.error("Error retrieving tasks: %s", e, exc_info=True)
+        return jresp({"error": "Failed to retrieve tasks"}, 500)
 
 @app.route('/api/tasks/<int:task_id>', methods=['GET'])
 def get_task(task_id):
-    with tracer.start_as_current_span("get_task_by_id") as span:
+    span = trace.get_current_span()
+    rec = span.is_recording()
+    if rec:
         span.set_attribute("task.id", task_id)
 
-        try:
-            query_start = time.time()
-            task = Task.query.get(task_id)
-            query_duration_time = time.time() - query_start
-
-            database_query_duration.record(query_duration_time, {
-                "operation": "select_by_id",
-                "table": "tasks"
-            })
+    try:
+        task = db.session.execute(SELECT_BY_ID, {"task_id": task_id}).one_or_none()
 
-            if not task:
+        if not task:
+            if rec:
                 span.set_attribute("task.found", False)
-                logger.warning(f"Task {task_id} not found")
-                return jsonify({"error": "Task not found"}), 404
+            logger.warning("Task %d not found", task_id)
+            return jresp({"error": "Task not found"}, 404)
 
+        if rec:
             span.set_attribute("task.found", True)
-            logger.info(f"Retrieved task {task_id}")
+        logger.info("Retrieved task %d", task_id)
 
-            return jsonify(task.to_dict()), 200
-        except Exception as e:
-            span.record_exception(e)
-            span.set_status(Status(StatusCode.ERROR, str(e)))
-            logger.error(f"Error retrieving task {task_id}: {str(e)}", exc_info=True)
-            return jsonify({"error": "Failed to retrieve task"}), 500
+        return jresp(task._asdict(), 200)
+    except Exception as e:
+        span.record_exception(e)
+        span.set_status(Status(StatusCode.ERROR, str(e)))
+        logger.error("Error retrieving task %d: %s", task_id, e, exc_info=True)
+        return jresp({"error": "Failed to retrieve task"}, 500)
 
 @app.route('/api/tasks', methods=['POST'])
 def create_task():
-    with tracer.start_as_current_span("create_task") as span:
-        try:
-            data = request.get_json()
+    span = trace.get_current_span()
+    rec = span.is_recording()
+    try:
+        data = request.get_json()
 
-            if not data or 'title' not in data:
+        if not data or 'title' not in data:
+            if rec:
                 span.set_attribute("validation.failed", True)
-                logger.warning("Task creation failed: missing title")
-                return jsonify({"error": "Title is required"}), 400
+            logger.warning("Task creation failed: missing title")
+            return jresp({"error": "Title is required"}, 400)
 
+        if rec:
             span.set_attribute("task.title", data['title'])
 
-            new_task = Task(
-                title=data['title'],
-                description=data.get('description', ''),
-                completed=data.get('completed', False)
-            )
-
-            query_start = time.time()
-            db.session.add(new_task)
-            db.session.commit()
-            query_duration_time = time.time() - query_start
-
-            database_query_duration.record(query_duration_time, {
-                "operation": "insert",
-                "table": "tasks"
+        query_start = perf_counter()
+        # One transaction per request: commits on exit, rolls back on error
+        with db.session.begin():
+            row = db.session.execute(INSERT_TASK, {
+                "title": data['title'],
+                "description": data.get('description', ''),
+                "completed": data.get('completed', False)
+            }).one()
+        query_duration_time = perf_counter() - query_start
+
+        if rec:
+            span.set_attributes({
+                "task.id": row.id,
+                "db.query.duration": query_duration_time
             })
 
-            span.set_attribute("task.id", new_task.id)
-            span.set_attribute("db.query.duration", query_duration_time)
+        logger.info("Created new task %d: %s", row.id, row.title)
 
-            logger.info(f"Created new task {new_task.id}: {new_task.title}")
-
-            return jsonify(new_task.to_dict()), 201
-        except Exception as e:
-            db.session.rollback()
-            span.record_exception(e)
-            span.set_status(Status(StatusCode.ERROR, str(e)))
-            logger.error(f"Error creating task: {str(e)}", exc_info=True)
-            return jsonify({"error": "Failed to create task"}), 500
+        return jresp(row._asdict(), 201)
+    except Exception as e:
+        span.record_exception(e)
+        span.set_status(Status(StatusCode.ERROR, str(e)))
+        logger.error("Error creating task: %s", e, exc_info=True)
+        return jresp({"error": "Failed to create task"}, 500)
 
 @app.route('/api/tasks/<int:task_id>', methods=['PUT'])
 def update_task(task_id):
-    with tracer.start_as_current_span("update_task") as span:
+    span = trace.get_current_span()
+    rec = span.is_recording()
+    if rec:
         span.set_attribute("task.id", task_id)
 
-        try:
-            task = Task.query.get(task_id)
-
-            if not task:
+    try:
+        data = request.get_json()
+        changes = {k: data[k] for k in ('title', 'description', 'completed') if k in data}
+        if 'completed' in changes and rec:
+            span.set_attribute("task.completed", changes['completed'])
+
+        query_start = perf_counter()
+        if changes:
+            # UPDATE ... RETURNING writes and reads back the row in one statement,
+            # without loading it first
+            with db.session.begin():
+                row = db.session.execute(UPDATE_BY_ID, {"task_id": task_id, **changes}).one_or_none()
+            task = row._asdict() if row else None
+        else:
+            existing = db.session.get(Task, task_id)
+            task = existing.to_dict() if existing else None
+        query_duration_time = perf_counter() - query_start
+
+        if not task:
+            if rec:
                 span.set_attribute("task.found", False)
-                logger.warning(f"Task {task_id} not found for update")
-                return jsonify({"error": "Task not found"}), 404
-
-            data = request.get_json()
-
-            if 'title' in data:
-                task.title = data['title']
-            if 'description' in data:
-                task.description = data['description']
-            if 'completed' in data:
-                task.completed = data['completed']
-                span.set_attribute("task.completed", data['completed'])
-
-            query_start = time.time()
-            db.session.commit()
-            query_duration_time = time.time() - query_start
-
-            database_query_duration.record(query_duration_time, {
-                "operation": "update",
-                "table": "tasks"
-            })
+            logger.warning("Task %d not found for update", task_id)
+            return jresp({"error": "Task not found"}, 404)
 
+        if rec:
             span.set_attribute("db.query.duration", query_duration_time)
-            logger.info(f"Updated task {task_id}")
+        logger.info("Updated task %d", task_id)
 
-            return jsonify(task.to_dict()), 200
-        except Exception as e:
-            db.session.rollback()
-            span.record_exception(e)
-            span.set_status(Status(StatusCode.ERROR, str(e)))
-            logger.error(f"Error updating task {task_id}: {str(e)}", exc_info=True)
-            return jsonify({"error": "Failed to update task"}), 500
+        return jresp(task, 200)
+    except Exception as e:
+        span.record_exception(e)
+        span.set_status(Status(StatusCode.ERROR, str(e)))
+        logger.error("Error updating task %d: %s", task_id, e, exc_info=True)
+        return jresp({"error": "Failed to update task"}, 500)
 
 @app.route('/api/tasks/<int:task_id>', methods=['DELETE'])
 def delete_task(task_id):
-    with tracer.start_as_current_span("delete_task") as span:
+    span = trace.get_current_span()
+    rec = span.is_recording()
+    if rec:
         span.set_attribute("task.id", task_id)
 
-        try:
-            task = Task.query.get(task_id)
-
-            if not task:
+    try:
+        # A single DELETE; rowcount tells us whether the task existed
+        query_start = perf_counter()
+        with db.session.begin():
+            result = db.session.execute(DELETE_BY_ID, {"task_id": task_id})
+        query_duration_time = perf_counter() - query_start
+
+        if result.rowcount == 0:
+            if rec:
                 span.set_attribute("task.found", False)
-                logger.warning(f"Task {task_id} not found for deletion")
-                return jsonify({"error": "Task not found"}), 404
-
-            query_start = time.time()
-            db.session.delete(task)
-            db.session.commit()
-            query_duration_time = time.time() - query_start
-
-            database_query_duration.record(query_duration_time, {
-                "operation": "delete",
-                "table": "tasks"
-            })
+            logger.warning("Task %d not found for deletion", task_id)
+            return jresp({"error": "Task not found"}, 404)
 
+        if rec:
             span.set_attribute("db.query.duration", query_duration_time)
-            logger.info(f"Deleted task {task_id}")
+        logger.info("Deleted task %d", task_id)
 
-            return jsonify({"message": "Task deleted successfully"}), 200
-        except Exception as e:
-            db.session.rollback()
-            span.record_exception(e)
-            span.set_status(Status(StatusCode.ERROR, str(e)))
-            logger.error(f"Error deleting task {task_id}: {str(e)}", exc_info=True)
-            return jsonify({"error": "Failed to delete task"}), 500
+        return jresp({"message": "Task deleted successfully"}, 200)
+    except Exception as e:
+        span.record_exception(e)
+        span.set_status(Status(StatusCode.ERROR, str(e)))
+        logger.error("Error deleting task %d: %s", task_id, e, exc_info=True)
+        return jresp({"error": "Failed to delete task"}, 500)
 
 @app.route('/api/simulate-error', methods=['GET'])
 def simulate_error():
-    with tracer.start_as_current_span("simulate_error") as span:
-        span.set_attribute("error.simulated", True)
-        logger.error("Simulated error triggered for testing")
-        span.set_status(Status(StatusCode.ERROR, "Simulated error"))
-        return jsonify({"error": "This is a simulated error"}), 500
+    span = trace.get_current_span()
+    rec = span.is_recording()
+    if rec:
+        span.set_attributes(SIMULATED_ERROR_SPAN_ATTRS)
+    logger.error("Simulated error triggered for testing")
+    span.set_status(Status(StatusCode.ERROR, "Simulated error"))
+    return jresp({"error": "This is a simulated error"}, 500)
 
 @app.route('/api/simulate-slow', methods=['GET'])
 def simulate_slow():
-    with tracer.start_as_current_span("simulate_slow_request") as span:
-        delay = float(request.args.get('delay', 2.0))
+    span = trace.get_current_span()
+    rec = span.is_recording()
+    delay = float(request.args.get('delay', 2.0))
+    if rec:
         span.set_attribute("delay.seconds", delay)
-        logger.info(f"Simulating slow request with {delay}s delay")
-        time.sleep(delay)
-        return jsonify({"message": f"Delayed response after {delay} seconds"}), 200
+    logger.info("Simulating slow request with %ss delay", delay)
+    time.sleep(delay)
+    return jresp({"message": f"Delayed response after {delay} seconds"}, 200)
+
+def _render_metrics():
+    # Under gunicorn each worker writes its samples to PROMETHEUS_MULTIPROC_DIR;
+    # aggregate all of them so a scrape sees the whole service, not one worker.
+    # process_* and python_gc_* are not exported in this mode: they would only
+    # describe whichever worker answered the scrape. python_info is the same in
+    # every worker, so it is kept.
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        PlatformCollector(registry=registry)
+        return generate_latest(registry)
+    return generate_latest()
 
 @app.route('/metrics', methods=['GET'])
 def metrics():
-    return Response(generate_latest(), mimetype=CONTENT_TYPE_LATEST)
+    now = time.monotonic()
+    if now - _metrics_cache["t"] > METRICS_CACHE_TTL:
+        with _metrics_lock:
+            # Re-check: another thread may have refreshed while we waited
+            if now - _metrics_cache["t"] > METRICS_CACHE_TTL:
+                body = _render_metrics()
+                _metrics_cache["body"] = body
+                _metrics_cache["gzip"] = gzip.compress(body, compresslevel=1)
+                _metrics_cache["t"] = now
+    if request.accept_encodings["gzip"]:
+        response = Response(_metrics_cache["gzip"], mimetype=CONTENT_TYPE_LATEST)
+        response.headers["Content-Encoding"] = "gzip"
+    else:
+        response = Response(_metrics_cache["body"], mimetype=CONTENT_TYPE_LATEST)
+    response.vary.add("Accept-Encoding")
+    return response
 
 @app.route('/api/smoke/db', methods=['POST'])
 def db_smoke():
-    from sqlalchemy.sql import text
-
     ops = int(request.args.get('ops', 200))
     mode = request.args.get('type', 'rw').lower()
 
     read_ops = ops if mode == 'read' else (ops // 2 if mode == 'rw' else 0)
     write_ops = 0 if mode == 'read' else (ops if mode == 'write' else ops - read_ops)
 
-    read_stmt = text('SELECT COUNT(*) FROM tasks')
+    # Fixed SQL string: exec_driver_sql skips statement compilation per read
+    read_sql = 'SELECT COUNT(*) FROM tasks'
 
     insert_stmt = text('INSERT INTO tasks (title, description, completed, created_at) VALUES (:t, :d, :c, :dt)')
     delete_stmt = text('DELETE FROM tasks WHERE title LIKE :prefix')
@@ -438,15 +677,17 @@ def db_smoke():
     try:
         with db.engine.connect() as conn:
             for _ in range(read_ops):
-                conn.execute(read_stmt)
+                conn.exec_driver_sql(read_sql)
 
         with db.engine.connect() as conn:
             trans = conn.begin()
             try:
-                for i in range(write_ops):
+                if write_ops:
+                    # One executemany batch; a single timestamp is fine for smoke rows
+                    now = datetime.utcnow().isoformat()
                     conn.execute(
                         insert_stmt,
-                        dict(t=f"smoke-{i}", d="smoke-test", c=False, dt=datetime.utcnow())
+                        [dict(t=f"smoke-{i}", d="smoke-test", c=False, dt=now) for i in range(write_ops)]
                     )
                 conn.execute(delete_stmt, dict(prefix='smoke-%'))
                 trans.rollback()
@@ -454,18 +695,18 @@ def db_smoke():
                 trans.rollback()
                 raise
 
-        logger.info(f"DB smoke test completed: {read_ops} reads, {write_ops} writes (rolled back)")
+        logger.info("DB smoke test completed: %d reads, %d writes (rolled back)", read_ops, write_ops)
 
-        return jsonify({
+        return jresp({
             "ok": True,
             "requested_ops": ops,
             "performed": {"read": read_ops, "write": write_ops},
             "note": "writes executed in a transaction and rolled back"
-        }), 200
+        }, 200)
 
     except Exception as e:
-        logger.error(f"DB smoke test failed: {str(e)}", exc_info=True)
-        return jsonify({"error": "DB smoke test failed", "details": str(e)}), 500
+        logger.error("DB smoke test failed: %s", e, exc_info=True)
+        return jresp({"error": "DB smoke test failed", "details": str(e)}, 500)
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000, debug=False)
@@ -0,0 +1,27 @@
+import os
+import shutil
+
+from prometheus_client import multiprocess
+
+bind = "0.0.0.0:5000"
+
+# gevent workers overlap requests while they wait on sockets (OTLP exports) or
+# sleeps. sqlite3 calls are C code and still block their worker's event loop,
+# so run more than one worker to keep serving while a query holds one.
+worker_class = "gevent"
+workers = int(os.getenv("GUNICORN_WORKERS", "2"))
+worker_connections = int(os.getenv("GUNICORN_WORKER_CONNECTIONS", "1000"))
+
+
+def on_starting(server):
+    # Workers share Prometheus metrics through files in this directory; start
+    # every run from an empty one so counters don't carry over restarts
+    path = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+    if path:
+        shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(path)
+
+
+def child_exit(server, worker):
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        multiprocess.mark_process_dead(worker.pid)